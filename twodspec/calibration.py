@@ -24,20 +24,21 @@ Aims
 
 """
 
-import itertools
-
 import numpy as np
 from astropy.io import fits
 from joblib import Parallel, delayed
-from scipy.interpolate import splrep, splev
+from numba import njit, prange
+from scipy.interpolate import CubicSpline, splrep, splev
+from scipy.ndimage import maximum_filter1d
 from scipy.optimize import curve_fit, leastsq
+from scipy.signal import fftconvolve
 
 
 # ############################## #
 #      fix thar spectra
 # ############################## #
 
-def thar1d_fix(thar1d, conv_len=20, sat_count=50000):
+def thar1d_fix(thar1d, conv_len=20, sat_count=50000, dtype=np.float32):
     """ fix thar image, particularly for negative & saturated pixels
 
     Parameters
@@ -46,6 +47,9 @@ def thar1d_fix(thar1d, conv_len=20, sat_count=50000):
         convolved length
     sat_count:
         saturated count / max count
+    dtype:
+        dtype of the fixed image, float32 is precise enough for the counts
+        (the line fits and the grating equation are done in float64)
 
     Return
     ------
@@ -53,17 +57,20 @@ def thar1d_fix(thar1d, conv_len=20, sat_count=50000):
         fixed THAR image
 
     """
-    # ind_sat_conv
-    ind_sat = thar1d >= sat_count
-    ind_sat_conv = np.zeros_like(ind_sat)
-    x_sat, y_sat = np.where(ind_sat)
-    for i in range(len(x_sat)):
-        ind_sat_conv[x_sat[i], y_sat[i] - conv_len:y_sat[i] + conv_len] = 1
-    # ind_neg
-    ind_neg = thar1d < 0.
-    # combine to ind_bad
-    ind_bad = np.logical_or(ind_neg, ind_sat_conv)
-    thar1d_fixed = np.where(ind_bad, 0, thar1d)
+    # ind_sat_conv, saturated pixels dilated along the dispersion direction,
+    # i.e., [y_sat - conv_len, y_sat + conv_len) in each row, which is empty
+    # for conv_len <= 0
+    ind_sat = np.asarray(thar1d) >= sat_count
+    if conv_len > 0:
+        ind_sat_conv = maximum_filter1d(
+            ind_sat.view(np.uint8), size=2 * conv_len, axis=1,
+            mode="constant", cval=0, origin=-1).view(bool)
+    else:
+        ind_sat_conv = np.zeros_like(ind_sat)
+    # negative pixels are clipped & saturated pixels are set to 0 in place
+    thar1d_fixed = np.array(thar1d, dtype=dtype, copy=True)
+    np.clip(thar1d_fixed, 0, None, out=thar1d_fixed)
+    np.copyto(thar1d_fixed, 0, where=ind_sat_conv)
 
     return thar1d_fixed
 
@@ -73,7 +80,8 @@ def thar1d_fix(thar1d, conv_len=20, sat_count=50000):
 # ############################## #
 
 def thar1d_corr2d(thar1d_fixed, thar_temp, x_shiftmax=20, y_shiftmax=5,
-                  verbose=False):
+                  verbose=False, method="fft", tile=128,
+                  dtype=np.float32):
     """ determine the shift of *thar1d_fixed* relative to *thar_temp*
 
     Parameters
@@ -90,6 +98,15 @@ def thar1d_corr2d(thar1d_fixed, thar_temp, x_shiftmax=20, y_shiftmax=5,
         the max y shift for correlation
     y_shiftmax: int
         the max y shift for correlation
+    method: str
+        "fft" -- FFT convolution
+        "direct" -- direct correlation in *tile* x *tile* blocks, which may
+            be faster for small shift windows
+    tile: int
+        the block size for method="direct"
+    dtype:
+        dtype of the images in the correlation, float32 halves the memory
+        traffic of this memory-bound step
 
     Returns
     -------
@@ -102,25 +119,33 @@ def thar1d_corr2d(thar1d_fixed, thar_temp, x_shiftmax=20, y_shiftmax=5,
     ytrim = (thar1d_fixed.shape[0] * np.array([.2, .8])).astype(int)
 
     # in case that the input data are int
-    thar1d_fixed = np.array(thar1d_fixed).astype(float)
-    thar_temp = np.array(thar_temp).astype(float)
+    thar1d_fixed = np.asarray(thar1d_fixed, dtype=dtype)
+    thar_temp = np.asarray(thar_temp, dtype=dtype)
 
     if verbose:
         print("@Cham: computing 2D cross-correlation...")
 
-    # initialize result
-    corr2d = np.zeros((1 + 2 * y_shiftmax, 1 + 2 * x_shiftmax))
     # make slice
     xslice_temp = slice(*xtrim)
     yslice_temp = slice(*ytrim)
-    # 2D correlation
-    for xofst in range(-x_shiftmax, x_shiftmax + 1, 1):
-        for yofst in range(-y_shiftmax, y_shiftmax + 1, 1):
-            xslice = slice(xtrim[0] + xofst, xtrim[1] + xofst, 1)
-            yslice = slice(ytrim[0] + yofst, ytrim[1] + yofst, 1)
-            corr2d[yofst + y_shiftmax, xofst + x_shiftmax] = \
-                np.mean(thar1d_fixed[yslice, xslice] *
-                        thar_temp[yslice_temp, xslice_temp])
+    # the trimmed image padded with the shift halo
+    xslice = slice(xtrim[0] - x_shiftmax, xtrim[1] + x_shiftmax, 1)
+    yslice = slice(ytrim[0] - y_shiftmax, ytrim[1] + y_shiftmax, 1)
+    thar1d_trim = thar1d_fixed[yslice, xslice]
+    thar_temp_trim = thar_temp[yslice_temp, xslice_temp]
+    if method == "fft":
+        # 2D correlation, i.e., the "valid" part of the convolution with the
+        # flipped template covers exactly the (2*y_shiftmax+1, 2*x_shiftmax+1)
+        # shifts, each element being sum(img[shifted window] * template)
+        corr2d = fftconvolve(thar1d_trim, thar_temp_trim[::-1, ::-1],
+                             mode="valid").astype(float)
+    elif method == "direct":
+        corr2d = corr2d_tiled(thar1d_trim, thar_temp_trim, x_shiftmax,
+                              y_shiftmax, tile=tile)
+    else:
+        raise ValueError("@TWODSPEC: bad method [{}]".format(method))
+    # normalize by window area to get the mean
+    corr2d /= thar_temp_trim.size
     # select maximum value
     y_, x_ = np.where(corr2d == np.max(corr2d))
     x_shift = np.int(x_shiftmax - x_)  # reverse sign
@@ -129,13 +154,40 @@ def thar1d_corr2d(thar1d_fixed, thar_temp, x_shiftmax=20, y_shiftmax=5,
     return (x_shift, y_shift), corr2d
 
 
+def corr2d_tiled(img, temp, x_shiftmax, y_shiftmax, tile=128):
+    """ sum(img[shifted window] * temp) for all shifts, computed in blocks
+
+    *img* is *temp* padded by (y_shiftmax, x_shiftmax) on each side. Each
+    *tile* x *tile* block of *temp* stays in cache while all shifted blocks
+    of *img* are multiplied with it.
+    """
+    n_y, n_x = 2 * y_shiftmax + 1, 2 * x_shiftmax + 1
+    corr2d = np.zeros((n_y, n_x))
+    for y0 in range(0, temp.shape[0], tile):
+        for x0 in range(0, temp.shape[1], tile):
+            temp_tile = np.ascontiguousarray(
+                temp[y0:y0 + tile, x0:x0 + tile])
+            h, w = temp_tile.shape
+            img_tile = img[y0:y0 + h + n_y - 1, x0:x0 + w + n_x - 1]
+            for iy in range(n_y):
+                for ix in range(n_x):
+                    corr2d[iy, ix] += np.einsum(
+                        "ij,ij->", img_tile[iy:iy + h, ix:ix + w], temp_tile)
+    return corr2d
+
+
 # ############################## #
 #      shift wave & order
 # ############################## #
 
-def interpolate_wavelength(w, shift, thar_temp, thar1d_fixed):
-    """ interpolate given a regerence wavelength solution and shift """
+def interpolate_wavelength(w, shift, thar_temp, thar1d_fixed,
+                           dtype=np.float64):
+    """ interpolate given a regerence wavelength solution and shift
+
+    float32 resolves only ~3E-4 A at 5000 A, so float64 is the default.
+    """
     xshift, yshift = shift
+    w = np.asarray(w, dtype=dtype)
 
     xcoord = np.arange(w.shape[1])
     ycoord = np.arange(w.shape[0])
@@ -144,29 +196,29 @@ def interpolate_wavelength(w, shift, thar_temp, thar1d_fixed):
     xcoord_xshift = xcoord + xshift
     ycoord_yshift = np.arange(
         w.shape[0] + thar1d_fixed.shape[0] - thar_temp.shape[0]) + yshift
-    # shfit X
-    w_x = np.zeros(w.shape)
-    for i in range(w.shape[0]):
-        s = splrep(xcoord, w[i], k=3, s=0)
-        w_x[i] = splev(xcoord_xshift, s)
-
-    # shift Y
-    w_x_y = np.zeros((thar1d_fixed.shape[0], w.shape[1]))
-    for j in range(w.shape[1]):
-        s = splrep(ycoord, w_x[:, j], k=3, s=0)
-        w_x_y[:, j] = splev(ycoord_yshift, s)
+    # shfit X, all rows at once
+    # (not-a-knot cubic splines, identical to splrep(k=3, s=0))
+    w_x = CubicSpline(xcoord, w, axis=1)(xcoord_xshift)
+
+    # shift Y, all columns at once
+    w_x_y = CubicSpline(ycoord, w_x, axis=0)(ycoord_yshift)
 
     return w_x_y
 
 
 def interpolate_order(order_temp, shift, thar1d_fixed):
+    """ interpolate order given a reference order & shift
+
+    The result is a read-only broadcast view, copy it if it is to be
+    modified in place.
+    """
     xshift, yshift = shift
 
     # for X, no difference, for Y, orders are different
     ycoord_yshift = np.arange(thar1d_fixed.shape[0]) + \
                     order_temp[0, 0] + yshift
-    order_interp = np.repeat(ycoord_yshift.reshape(-1, 1),
-                             thar1d_fixed.shape[1], axis=1)
+    order_interp = np.broadcast_to(ycoord_yshift[:, None],
+                                   thar1d_fixed.shape[:2])
 
     return order_interp
 
@@ -188,12 +240,31 @@ def load_thar_temp(thar_temp_path):
 # ############################## #
 
 def refine_thar_positions(wave_init, order_init, thar1d_fixed, thar_list,
-                          fit_width=5., lc_tol=5., k=3, n_jobs=10, verbose=10):
-    """ refine ThAr positions """
+                          fit_width=5., lc_tol=5., k=3, n_jobs=10, verbose=10,
+                          method="curve_fit", centroid_method="fit",
+                          snr_max=500., width_tol=0.2, backend=None):
+    """ refine ThAr positions
+
+    method:
+        the fit of the ThAr lines, "curve_fit", "numba" or "batch", see
+        refine_thar_positions_order
+    centroid_method:
+        "fit" or "fast", see refine_thar_positions_order
+    snr_max, width_tol:
+        the gates of centroid_method="fast", see refine_thar_positions_order
+    backend:
+        the joblib backend, by default "threading" for the numba & batch
+        methods which release the GIL (no pickling of the data for each
+        order), and "loky" for curve_fit. The numba fits of the lines in
+        an order are parallel only if n_jobs=1.
+    """
     print("@TWODSPEC: refine ThAr positions ...")
+    if backend is None:
+        backend = "loky" if method == "curve_fit" else "threading"
 
     # refine thar positions for each order
-    r = Parallel(n_jobs=n_jobs, verbose=verbose, batch_size=1)(
+    r = Parallel(n_jobs=n_jobs, verbose=verbose, backend=backend,
+                 batch_size="auto")(
         delayed(refine_thar_positions_order)(
             wave_init[i_order],
             np.arange(wave_init.shape[1]),
@@ -201,56 +272,120 @@ def refine_thar_positions(wave_init, order_init, thar1d_fixed, thar_list,
             thar_list[(thar_list > np.min(wave_init[i_order]) + 1.) * (
                 thar_list < np.max(wave_init[i_order]) - 1.)],
             order_init[i_order, 0],
-            fit_width=fit_width, lc_tol=lc_tol, k=k
+            fit_width=fit_width, lc_tol=lc_tol, k=k, method=method,
+            centroid_method=centroid_method, snr_max=snr_max,
+            width_tol=width_tol,
+            # numba parallel regions can not be entered by multiple threads
+            # at once, and a numba thread pool in each of the n_jobs
+            # processes would oversubscribe the cores
+            parallel=n_jobs == 1
         ) for i_order in range(wave_init.shape[0]))
 
-    # remove all null values
-    null_value = None
-    for i in range(r.count(null_value)):
-        r.remove(null_value)
-        # print(len(r))
-
-    # collect data
-    lc_coord = np.array(np.hstack([_[0] for _ in r]))
-    lc_order = np.array(np.hstack([_[1] for _ in r]))
-    lc_thar = np.array(np.hstack([_[2] for _ in r]))
-    popt = np.array(np.vstack([_[3] for _ in r]))
-    pcov = np.array(np.vstack([_[4] for _ in r]))
+    # collect data, skipping orders without lines (None)
+    n_total = np.sum([len(_[2]) for _ in r if _ is not None], dtype=int)
+    lc_coord = np.empty((n_total,))
+    lc_order = np.empty((n_total,))
+    lc_thar = np.empty((n_total,))
+    popt = np.empty((n_total, 4))
+    pcov = np.empty((n_total, 4))
+    i_start = 0
+    for _ in r:
+        if _ is None:
+            continue
+        i_stop = i_start + len(_[2])
+        lc_coord[i_start:i_stop] = _[0]
+        lc_order[i_start:i_stop] = _[1]
+        lc_thar[i_start:i_stop] = _[2]
+        popt[i_start:i_stop] = _[3]
+        pcov[i_start:i_stop] = _[4]
+        i_start = i_stop
 
     return lc_coord, lc_order, lc_thar, popt, pcov
 
 
 def refine_thar_positions_order(this_wave_init, this_xcoord, this_thar,
                                 this_thar_list, this_order, fit_width=5.,
-                                lc_tol=5., k=3):
+                                lc_tol=5., k=3, method="curve_fit",
+                                centroid_method="fit", snr_max=500.,
+                                width_tol=0.2, parallel=True):
+    """ refine ThAr positions in one order
+
+    method:
+        "curve_fit" -- scipy.optimize.curve_fit for each line
+        "numba" -- jitted Levenberg-Marquardt fits, parallel over lines;
+            lines it fails to fit are re-fitted with curve_fit. In blended
+            windows it may settle in a different local minimum.
+        "batch" -- Gauss-Newton fits of all lines at once in numpy, with
+            the same fallback & caveat as "numba"
+    centroid_method:
+        "fit" -- fit all lines with *method*
+        "fast" -- use the log-parabola centroids of centroid_gauss_poly0,
+            lines which are not clearly Gaussian-like (blends, bright or
+            off by more than lc_tol) are still fitted with *method*
+    snr_max, width_tol:
+        the SNR & width gates of centroid_method="fast", lines brighter
+        than snr_max or whose width is off the FWHM by more than width_tol
+        are fitted
+    parallel:
+        if True, fit lines in parallel threads (method="numba")
+    """
     if len(this_thar_list) == 0:
         return None
 
-    popt_list = []
-    pcov_list = []
-
-    # refine all thar positions in this order
-    for i_thar_line, each_thar_line in enumerate(this_thar_list):
-
-        # cut local spectrum
-        ind_local = (this_wave_init > each_thar_line - fit_width) * (
-            this_wave_init < each_thar_line + fit_width)
-
-        # set bounds
-        p0 = (0., 1E5, each_thar_line, 0.1)
-        bounds = ((-1., 0., each_thar_line - lc_tol, 0.01),
-                  (+np.inf, np.inf, each_thar_line + lc_tol, 2.))
-
-        try:
-            popt, pcov = curve_fit(gauss_poly0, this_wave_init[ind_local],
-                                   this_thar[ind_local], p0=p0, bounds=bounds)
-            pcov = np.diagonal(pcov)
-        except RuntimeError:
-            popt = np.ones_like(p0) * np.nan
-            pcov = np.ones((len(p0),)) * np.nan
-
-        popt_list.append(popt)
-        pcov_list.append(pcov)
+    this_wave_init = np.asarray(this_wave_init, dtype=float)
+    this_thar = np.asarray(this_thar, dtype=float)
+    this_thar_list = np.asarray(this_thar_list, dtype=float)
+
+    if centroid_method == "fast":
+        popt_list, pcov_list = centroid_gauss_poly0(
+            this_wave_init, this_thar, this_thar_list, fit_width, lc_tol,
+            snr_max=snr_max, width_tol=width_tol)
+        ind_fit = ~np.isfinite(popt_list[:, 2])
+    elif centroid_method == "fit":
+        popt_list = np.zeros((len(this_thar_list), 4))
+        pcov_list = np.zeros((len(this_thar_list), 4))
+        ind_fit = np.ones((len(this_thar_list),), dtype=bool)
+    else:
+        raise ValueError(
+            "@TWODSPEC: bad centroid_method [{}]".format(centroid_method))
+    thar_list_fit = this_thar_list[ind_fit]
+
+    if not np.any(ind_fit):
+        pass
+    elif method == "numba":
+        fit_lines_nb = fit_gauss_poly0_lines_nb if parallel else \
+            fit_gauss_poly0_lines_serial_nb
+        popt_list[ind_fit], pcov_list[ind_fit] = fit_lines_nb(
+            this_wave_init, this_thar, thar_list_fit,
+            float(fit_width), float(lc_tol))
+        # re-fit failed lines with curve_fit
+        for i_thar_line in np.where(
+                ind_fit & ~np.isfinite(popt_list[:, 2]))[0]:
+            each_thar_line = this_thar_list[i_thar_line]
+            ind_local = (this_wave_init > each_thar_line - fit_width) * (
+                this_wave_init < each_thar_line + fit_width)
+            if np.any(ind_local):
+                popt_list[i_thar_line], pcov_list[i_thar_line] = \
+                    fit_gauss_poly0(this_wave_init[ind_local],
+                                    this_thar[ind_local], each_thar_line,
+                                    lc_tol)
+    elif method == "batch":
+        popt_list[ind_fit], pcov_list[ind_fit] = fit_gauss_poly0_batch(
+            this_wave_init, this_thar, thar_list_fit, fit_width, lc_tol)
+    elif method == "curve_fit":
+        # refine all thar positions in this order
+        for i_thar_line in np.where(ind_fit)[0]:
+            each_thar_line = this_thar_list[i_thar_line]
+
+            # cut local spectrum
+            ind_local = (this_wave_init > each_thar_line - fit_width) * (
+                this_wave_init < each_thar_line + fit_width)
+
+            popt_list[i_thar_line], pcov_list[i_thar_line] = fit_gauss_poly0(
+                this_wave_init[ind_local], this_thar[ind_local],
+                each_thar_line, lc_tol)
+    else:
+        raise ValueError("@TWODSPEC: bad method [{}]".format(method))
 
     # interpolation for X corrdinates
     if np.all(np.diff(this_wave_init) >= 0):
@@ -262,33 +397,578 @@ def refine_thar_positions_order(this_wave_init, this_xcoord, this_thar,
     else:
         raise (ValueError("@Cham: error occurs in interpolation!"))
 
-    # lccov_list = np.array(lccov_list)
-    popt_list = np.array(popt_list)
-    pcov_list = np.array(pcov_list)
-
     lc_coord = splev(popt_list[:, 2], tck)
     lc_order = np.ones_like(lc_coord) * this_order
 
     return lc_coord, lc_order, this_thar_list, popt_list, pcov_list
 
 
+def _peak_region(Y, i_peak, level):
+    """ the contiguous pixels of each row of Y above level around i_peak,
+    returns the (left, right) indices just outside, -1 & Y.shape[1] if the
+    region extends to the edge """
+    n_width = Y.shape[1]
+    below = ~(Y > level[:, None])
+    ind = np.arange(n_width)
+    i_left = np.max(np.where(below & (ind < i_peak[:, None]), ind, -1),
+                    axis=1)
+    i_right = np.min(np.where(below & (ind > i_peak[:, None]), ind,
+                              n_width), axis=1)
+    return i_left, i_right
+
+
+def centroid_gauss_poly0(wave, thar, thar_list, fit_width, lc_tol,
+                         snr_max=500., width_tol=0.2):
+    """ estimate gauss_poly0 parameters of ThAr lines without fitting
+
+    The background is the minimum of the local spectrum. The center & width
+    are those of a parabola fitted to the log of the background-subtracted
+    flux above 20% of the peak, weighted by its Poisson noise (Guo 2011).
+
+    Only clearly Gaussian-like lines are estimated, i.e.,
+        - no pixel out of the region around the peak is above 20% of the
+          peak or a significant (5 sigma) local maximum (no blends),
+        - the width agrees with the FWHM within *width_tol*,
+        - the center is within lc_tol & the width within the bounds used
+          in fit_gauss_poly0,
+        - the SNR of the peak is below *snr_max*, above which the
+          sub-pixel precision of the fit matters.
+
+    Returns
+    -------
+    popt_list, pcov_list
+        NaNs are returned for the other lines, which should be fitted.
+        Only the variance of the center is estimated.
+    """
+    n_lines = len(thar_list)
+    rows = np.arange(n_lines)
+
+    # cut local spectra, padded to the max width
+    ind_local = (wave > thar_list[:, None] - fit_width) * (
+        wave < thar_list[:, None] + fit_width)
+    n_local = np.sum(ind_local, axis=1)
+    n_width = np.max((np.max(n_local, initial=0), 3))
+    sub_local = np.argsort(~ind_local, axis=1, kind="stable")[:, :n_width]
+    valid = np.arange(n_width) < n_local[:, None]
+    X = wave[sub_local]
+    T = np.where(valid, thar[sub_local], np.inf)
+    bg = np.min(T, axis=1)
+    bg = np.where(np.isfinite(bg), bg, 0.)
+    Y = np.where(valid, T - bg[:, None], -np.inf)
+    i_peak = np.argmax(Y, axis=1)
+    y_peak = Y[rows, i_peak]
+    x_peak = X[rows, i_peak]
+
+    # weighted parabola fit to log(flux) in the peak region
+    i_left, i_right = _peak_region(Y, i_peak, 0.2 * y_peak)
+    ind = np.arange(n_width)
+    in_region = (ind > i_left[:, None]) & (ind < i_right[:, None])
+    # other pixels above 20% of the peak or other significant local maxima
+    Y_pad = np.pad(Y, ((0, 0), (1, 1)), constant_values=-np.inf)
+    local_max = (Y > Y_pad[:, :-2]) & (Y >= Y_pad[:, 2:]) & \
+        (Y > 5. * np.sqrt(np.maximum(T, 1.)))
+    blended = (np.sum(Y > 0.2 * y_peak[:, None], axis=1) !=
+               np.sum(in_region, axis=1)) | \
+        np.any(local_max & ~in_region, axis=1)
+    dX = np.where(in_region, X - x_peak[:, None], 0.)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logY = np.where(in_region, np.log(Y), 0.)
+        W = np.where(in_region, Y ** 2. / np.maximum(T, 1.), 0.)
+        powers = dX[:, :, None] ** np.arange(3)
+        ata = np.einsum("nwi,nwj,nw->nij", powers, powers, W)
+        atb = np.einsum("nwi,nw->ni", powers, W * logY)
+    ind_solve = np.sum(in_region, axis=1) >= 3
+    coefs = np.ones((n_lines, 3)) * np.nan
+    cov = np.ones((n_lines, 3, 3)) * np.nan
+    ind_solve[ind_solve] &= np.linalg.matrix_rank(ata[ind_solve]) == 3
+    cov[ind_solve] = np.linalg.inv(ata[ind_solve])
+    coefs[ind_solve] = np.einsum("nij,nj->ni", cov[ind_solve],
+                                 atb[ind_solve])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        c0, c1, c2 = coefs.T
+        b_fast = x_peak - c1 / c2 / 2.
+        c_fast = np.sqrt(-0.5 / c2)
+        a_fast = np.sqrt(2. * np.pi) * c_fast * np.exp(c0 - c1 ** 2. / c2 / 4.)
+        # variance of the center, propagated from the parabola
+        jac = np.array([np.zeros_like(c1), -0.5 / c2, 0.5 * c1 / c2 ** 2.]).T
+        b_var = np.einsum("ni,nij,nj->n", jac, cov, jac)
+        snr = y_peak / np.sqrt(np.maximum(y_peak + bg, 1.))
+
+    # FWHM by linear interpolation at the half maximum crossings
+    half = y_peak / 2.
+    i_hm_left, i_hm_right = _peak_region(Y, i_peak, half)
+    hm_inside = (i_hm_left >= 0) & (i_hm_right < n_local)
+    i0 = np.clip(i_hm_left, 0, n_width - 2)
+    i1 = np.clip(i_hm_right, 1, n_width - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_hm_left = X[rows, i0] + (half - Y[rows, i0]) * (
+            X[rows, i0 + 1] - X[rows, i0]) / (Y[rows, i0 + 1] - Y[rows, i0])
+        x_hm_right = X[rows, i1] + (half - Y[rows, i1]) * (
+            X[rows, i1 - 1] - X[rows, i1]) / (Y[rows, i1 - 1] - Y[rows, i1])
+        c_hm = np.abs(x_hm_right - x_hm_left) / (2. * np.sqrt(2. * np.log(2.)))
+        ind_good = ind_solve & (c2 < 0) & ~blended & hm_inside & \
+            (np.abs(c_fast / c_hm - 1.) < width_tol) & (snr < snr_max) & \
+            (np.abs(b_fast - thar_list) < lc_tol) & \
+            (c_fast > 0.01) & (c_fast < 2.)
+
+    popt_list = np.array([bg, a_fast, b_fast, c_fast]).T
+    pcov_list = np.ones_like(popt_list) * np.nan
+    pcov_list[:, 2] = b_var
+    popt_list[~ind_good] = np.nan
+    pcov_list[~ind_good] = np.nan
+    return popt_list, pcov_list
+
+
+def fit_gauss_poly0(x, y, each_thar_line, lc_tol):
+    """ fit gauss_poly0 to one ThAr line using scipy.optimize.curve_fit
+
+    Returns
+    -------
+    popt, diag(pcov)
+        NaNs are returned if the fit fails
+    """
+    # set bounds
+    p0 = (0., 1E5, each_thar_line, 0.1)
+    bounds = ((-1., 0., each_thar_line - lc_tol, 0.01),
+              (+np.inf, np.inf, each_thar_line + lc_tol, 2.))
+
+    try:
+        popt, pcov = curve_fit(gauss_poly0, x, y, p0=p0, bounds=bounds,
+                               jac=gauss_poly0_jac, check_finite=False,
+                               xtol=1e-6, ftol=1e-6)
+        pcov = np.diagonal(pcov)
+    except RuntimeError:
+        popt = np.ones_like(p0) * np.nan
+        pcov = np.ones((len(p0),)) * np.nan
+    return popt, pcov
+
+
+def fit_gauss_poly0_batch(wave, thar, thar_list, fit_width, lc_tol,
+                          max_iter=20, xtol=1e-8, ftol=1e-8, theta=0.995):
+    """ fit gauss_poly0 to all ThAr lines in one order simultaneously
+
+    Local spectra are padded to a common width and a damped Gauss-Newton
+    (Levenberg-Marquardt) step is solved for all lines at once. The
+    iterates are kept strictly inside the bounds as in fit_gauss_poly0_nb.
+    Lines not converged within *max_iter* iterations, or whose amplitude
+    collapses onto its bound, are re-fitted with curve_fit.
+
+    Returns
+    -------
+    popt_list, pcov_list
+        the best-fit parameters & the diagonal of their covariance, NaNs
+        for lines without data points in the window
+    """
+    n_lines = len(thar_list)
+    m = 4
+
+    # cut local spectra, padded to the max width
+    ind_local = (wave > thar_list[:, None] - fit_width) * (
+        wave < thar_list[:, None] + fit_width)
+    n_local = np.sum(ind_local, axis=1)
+    n_width = np.max((np.max(n_local), 1))
+    sub_local = np.argsort(~ind_local, axis=1, kind="stable")[:, :n_width]
+    valid = np.arange(n_width) < n_local[:, None]
+    X = np.where(valid, wave[sub_local], thar_list[:, None])
+    Y = np.where(valid, thar[sub_local], 0.)
+
+    # set bounds
+    p = np.zeros((n_lines, m))
+    p[:] = 0., 1E5, 0., 0.1
+    p[:, 2] = thar_list
+    lb = np.zeros((n_lines, m))
+    lb[:] = -1., 0., 0., 0.01
+    lb[:, 2] = thar_list - lc_tol
+    ub = np.zeros((n_lines, m))
+    ub[:] = np.inf, np.inf, 0., 2.
+    ub[:, 2] = thar_list + lc_tol
+
+    def res_jac(p):
+        r = (gauss_poly0(X, *p[:, :, None].transpose(1, 0, 2)) - Y) * valid
+        jac = gauss_poly0_jac(X, *p[:, :, None].transpose(1, 0, 2)) * \
+            valid[:, :, None]
+        return r, jac
+
+    def bounded_step(a, g, p, scale, lb, ub, theta):
+        # as _bounded_step_nb for all lines at once, parameters which would
+        # cross a bound step back to a fraction theta of the distance to it,
+        # the others are solved again
+        a = a.copy()
+        g = g.copy()
+        p_new = p.copy()
+        hit = np.zeros(p.shape, dtype=bool)
+        for i_pass in range(p.shape[1] + 1):
+            p_try = p + np.linalg.solve(a, g[:, :, None])[:, :, 0] / scale
+            new_hit = ~hit & ((p_try <= lb) | (p_try >= ub))
+            p_new = np.where(hit, p_new, p_try)
+            if not np.any(new_hit):
+                break
+            bound = np.where(p_try <= lb, lb, ub)
+            p_back = p + theta * (bound - p)
+            # too close to the bound to step towards it
+            p_back = np.where(p_back == bound, p, p_back)
+            p_new = np.where(new_hit, p_back, p_new)
+            hit |= new_hit
+            i_line, i_par = np.nonzero(new_hit)
+            a[i_line, i_par, :] = 0.
+            a[i_line, i_par, i_par] = 1.
+            g[new_hit] = ((p_new - p) * scale)[new_hit]
+        return p_new
+
+    eye = np.eye(m)
+    r, jac = res_jac(p)
+    cost = np.sum(r ** 2., axis=1)
+    lam = np.ones((n_lines,)) * 1e-3
+    scale = np.zeros((n_lines, m))
+    converged = n_local == 0
+    for i_iter in range(max_iter):
+        if np.all(converged):
+            break
+        jtj = np.einsum("nwi,nwj->nij", jac, jac)
+        jtr = np.einsum("nwi,nw->ni", jac, r)
+        # the largest column norms so far, as in fit_gauss_poly0_nb
+        scale = np.maximum(
+            scale, np.sqrt(np.diagonal(jtj, axis1=1, axis2=2)))
+        scale = np.where(scale > 0, scale, 1.)
+        a = jtj / scale[:, :, None] / scale[:, None, :] + \
+            lam[:, None, None] * eye
+        p_new = bounded_step(a, -jtr / scale, p, scale, lb, ub, theta)
+        r_new, jac_new = res_jac(p_new)
+        cost_new = np.sum(r_new ** 2., axis=1)
+        # accept improved steps of the unconverged lines
+        better = (cost_new < cost) & ~converged
+        converged |= better & (
+            (cost - cost_new <= ftol * cost_new) |
+            np.all(np.abs(p_new - p) <= xtol * (xtol + np.abs(p_new)), axis=1))
+        # no descent direction is left
+        converged |= ~better & (lam >= 1e16)
+        p[better] = p_new[better]
+        r[better] = r_new[better]
+        jac[better] = jac_new[better]
+        cost[better] = cost_new[better]
+        lam = np.where(better, np.maximum(lam / 10., 1e-12), lam * 10.)
+
+    # the amplitude is pressed onto its bound, see fit_gauss_poly0_nb
+    jtr_a = np.sum(jac[:, :, 1] * r, axis=1)
+    jtj_aa = np.sum(jac[:, :, 1] ** 2., axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        converged &= ~((jtj_aa > 0) & (p[:, 1] - jtr_a / jtj_aa <= lb[:, 1]))
+
+    # covariance, inf if the Jacobian is rank-deficient as in curve_fit
+    jtj = np.einsum("nwi,nwj->nij", jac, jac)
+    s_sq = np.where(n_local > m, cost / np.maximum(n_local - m, 1), np.inf)
+    pcov = np.ones((n_lines, m)) * np.inf
+    full_rank = np.linalg.matrix_rank(jac) == m
+    pcov[full_rank] = np.diagonal(
+        np.linalg.inv(jtj[full_rank]), axis1=1, axis2=2) * \
+        s_sq[full_rank, None]
+    popt_list = p
+    pcov_list = pcov
+
+    # no data in the window
+    popt_list[n_local == 0] = np.nan
+    pcov_list[n_local == 0] = np.nan
+
+    # fall back to curve_fit
+    for i_thar_line in np.where(~converged)[0]:
+        popt_list[i_thar_line], pcov_list[i_thar_line] = fit_gauss_poly0(
+            X[i_thar_line, valid[i_thar_line]],
+            Y[i_thar_line, valid[i_thar_line]],
+            thar_list[i_thar_line], lc_tol)
+    return popt_list, pcov_list
+
+
+@njit(cache=True, nogil=True)
+def _gauss_poly0_res_jac_nb(x, y, p, r, jac):
+    """ residual & analytic Jacobian of gauss_poly0, written to r & jac """
+    inv = 1. / (np.sqrt(2. * np.pi) * p[3])
+    for i in range(x.shape[0]):
+        d = (x[i] - p[2]) / p[3]
+        e = inv * np.exp(-0.5 * d * d)
+        r[i] = p[0] + p[1] * e - y[i]
+        jac[i, 0] = 1.
+        jac[i, 1] = e
+        jac[i, 2] = p[1] * e * d / p[3]
+        jac[i, 3] = p[1] * e * (d * d - 1.) / p[3]
+
+
+@njit(cache=True, nogil=True)
+def _gauss_poly0_cost_nb(x, y, p):
+    """ sum of squared residuals of gauss_poly0 """
+    inv = 1. / (np.sqrt(2. * np.pi) * p[3])
+    cost = 0.
+    for i in range(x.shape[0]):
+        d = (x[i] - p[2]) / p[3]
+        ri = p[0] + p[1] * inv * np.exp(-0.5 * d * d) - y[i]
+        cost += ri * ri
+    return cost
+
+
+@njit(cache=True, nogil=True)
+def _solve_nb(a, b):
+    """ solve a small linear system by Gaussian elimination with partial
+    pivoting, returns (x, success) instead of raising on singular matrix """
+    n = b.shape[0]
+    a = a.copy()
+    x = b.copy()
+    for j in range(n):
+        i_pivot = j
+        for i in range(j + 1, n):
+            if abs(a[i, j]) > abs(a[i_pivot, j]):
+                i_pivot = i
+        if not abs(a[i_pivot, j]) > 0.:
+            return x, False
+        if i_pivot != j:
+            for jj in range(n):
+                a[j, jj], a[i_pivot, jj] = a[i_pivot, jj], a[j, jj]
+            x[j], x[i_pivot] = x[i_pivot], x[j]
+        for i in range(j + 1, n):
+            f = a[i, j] / a[j, j]
+            for jj in range(j, n):
+                a[i, jj] -= f * a[j, jj]
+            x[i] -= f * x[j]
+    for j in range(n - 1, -1, -1):
+        for jj in range(j + 1, n):
+            x[j] -= a[j, jj] * x[jj]
+        x[j] /= a[j, j]
+    return x, True
+
+
+@njit(cache=True, nogil=True)
+def _bounded_step_nb(a, g, p, scale, lb, ub, theta):
+    """ solve the scaled step a @ z = g, parameters which would cross a
+    bound step back to a fraction theta of the distance to it and the
+    others are solved again with these steps fixed, returns (p_new, ok)
+    """
+    m = p.shape[0]
+    a = a.copy()
+    g = g.copy()
+    p_new = p.copy()
+    hit = np.zeros(m, dtype=np.bool_)
+    for i_pass in range(m + 1):
+        z, ok = _solve_nb(a, g)
+        if not ok:
+            return p_new, False
+        new_hit = False
+        for i in range(m):
+            if hit[i]:
+                continue
+            p_new[i] = p[i] + z[i] / scale[i]
+            if p_new[i] <= lb[i] or p_new[i] >= ub[i]:
+                bound = lb[i] if p_new[i] <= lb[i] else ub[i]
+                p_new[i] = p[i] + theta * (bound - p[i])
+                if p_new[i] == bound:
+                    # too close to the bound to step towards it
+                    p_new[i] = p[i]
+                hit[i] = True
+                new_hit = True
+                a[i, :] = 0.
+                a[i, i] = 1.
+                g[i] = (p_new[i] - p[i]) * scale[i]
+        if not new_hit:
+            break
+    return p_new, True
+
+
+@njit(cache=True, nogil=True)
+def fit_gauss_poly0_nb(x, y, p0, lb, ub, max_iter=200, xtol=1e-8, ftol=1e-8,
+                       theta=0.995):
+    """ bounded Levenberg-Marquardt fit of gauss_poly0
+
+    The steps are Marquardt-scaled. The iterates are kept strictly inside
+    [lb, ub]: parameters that would cross a bound step back to a fraction
+    theta of the distance to it, as in scipy.optimize.least_squares "trf".
+    On the bound a=0 the Jacobian of b & c vanishes and the fit could not
+    leave it.
+
+    Returns
+    -------
+    popt, diag(pcov), success
+        pcov is estimated as in scipy.optimize.curve_fit. success is False
+        if the amplitude collapses onto its lower bound, which happens in
+        blended windows where curve_fit moves to a neighbouring line.
+    """
+    n = x.shape[0]
+    m = p0.shape[0]
+    popt = np.minimum(np.maximum(p0, lb), ub)
+    pcov = np.full(m, np.inf)
+    if n == 0:
+        return popt, pcov, False
+
+    r = np.empty(n)
+    jac = np.empty((n, m))
+    _gauss_poly0_res_jac_nb(x, y, popt, r, jac)
+    cost = np.sum(r * r)
+    jtj = np.empty((m, m))
+    jtr = np.empty(m)
+    scale = np.zeros(m)
+    lam = 1e-3
+    success = False
+    for i_iter in range(max_iter):
+        # normal equations
+        for i in range(m):
+            jtr[i] = np.sum(jac[:, i] * r)
+            for j in range(i, m):
+                jtj[i, j] = np.sum(jac[:, i] * jac[:, j])
+                jtj[j, i] = jtj[i, j]
+        # the largest column norms so far, as in MINPACK, so that the
+        # steps of b & c do not blow up when the amplitude gets small
+        for i in range(m):
+            scale[i] = max(scale[i], np.sqrt(jtj[i, i]))
+            if not scale[i] > 0.:
+                scale[i] = 1.
+        # increase damping until the cost decreases
+        improved = False
+        while lam < 1e16:
+            a = jtj / np.outer(scale, scale)
+            g = -jtr / scale
+            for i in range(m):
+                a[i, i] += lam
+            p_new, ok = _bounded_step_nb(a, g, popt, scale, lb, ub, theta)
+            if ok:
+                cost_new = _gauss_poly0_cost_nb(x, y, p_new)
+                if cost_new < cost:
+                    improved = True
+                    break
+            lam *= 10.
+        if not improved:
+            # no descent direction is left
+            success = True
+            break
+        dp = p_new - popt
+        dcost = cost - cost_new
+        popt = p_new
+        cost = cost_new
+        lam = max(lam / 10., 1e-12)
+        _gauss_poly0_res_jac_nb(x, y, popt, r, jac)
+        if dcost <= ftol * cost or \
+                np.all(np.abs(dp) <= xtol * (xtol + np.abs(popt))):
+            success = True
+            break
+
+    # the amplitude is pressed onto its bound if a Gauss-Newton step in
+    # the amplitude alone would cross it
+    jtr_a = np.sum(jac[:, 1] * r)
+    jtj_aa = np.sum(jac[:, 1] * jac[:, 1])
+    if jtj_aa > 0. and popt[1] - jtr_a / jtj_aa <= lb[1]:
+        success = False
+
+    # covariance
+    if n > m:
+        for i in range(m):
+            for j in range(i, m):
+                jtj[i, j] = np.sum(jac[:, i] * jac[:, j])
+                jtj[j, i] = jtj[i, j]
+        s_sq = cost / (n - m)
+        for i in range(m):
+            e = np.zeros(m)
+            e[i] = 1.
+            col, ok = _solve_nb(jtj, e)
+            pcov[i] = col[i] * s_sq if ok else np.inf
+    return popt, pcov, success
+
+
+@njit(cache=True, nogil=True)
+def _fit_gauss_poly0_line_nb(wave, thar, each_thar_line, fit_width, lc_tol):
+    """ fit gauss_poly0 to one ThAr line, NaNs if the fit fails """
+    # cut local spectrum
+    ind_local = (wave > each_thar_line - fit_width) & (
+        wave < each_thar_line + fit_width)
+
+    # set bounds
+    p0 = np.array([0., 1E5, each_thar_line, 0.1])
+    lb = np.array([-1., 0., each_thar_line - lc_tol, 0.01])
+    ub = np.array([np.inf, np.inf, each_thar_line + lc_tol, 2.])
+
+    popt, pcov, success = fit_gauss_poly0_nb(
+        wave[ind_local], thar[ind_local], p0, lb, ub)
+    if not success:
+        popt[:] = np.nan
+        pcov[:] = np.nan
+    return popt, pcov
+
+
+@njit(cache=True, parallel=True)
+def fit_gauss_poly0_lines_nb(wave, thar, thar_list, fit_width, lc_tol):
+    """ fit gauss_poly0 to all ThAr lines in one order in parallel """
+    n_lines = thar_list.shape[0]
+    popt_list = np.empty((n_lines, 4))
+    pcov_list = np.empty((n_lines, 4))
+    for i_thar_line in prange(n_lines):
+        popt_list[i_thar_line], pcov_list[i_thar_line] = \
+            _fit_gauss_poly0_line_nb(wave, thar, thar_list[i_thar_line],
+                                     fit_width, lc_tol)
+    return popt_list, pcov_list
+
+
+@njit(cache=True, nogil=True)
+def fit_gauss_poly0_lines_serial_nb(wave, thar, thar_list, fit_width,
+                                    lc_tol):
+    """ fit gauss_poly0 to all ThAr lines in one order without releasing
+    threads, safe to be called from multiple threads at the same time """
+    n_lines = thar_list.shape[0]
+    popt_list = np.empty((n_lines, 4))
+    pcov_list = np.empty((n_lines, 4))
+    for i_thar_line in range(n_lines):
+        popt_list[i_thar_line], pcov_list[i_thar_line] = \
+            _fit_gauss_poly0_line_nb(wave, thar, thar_list[i_thar_line],
+                                     fit_width, lc_tol)
+    return popt_list, pcov_list
+
+
 # ############################## #
 #      2D surface fit
 # ############################## #
 
-def polyval2d(x, y, coefs, orders=None):
+def polyval2d_powers(x, y, orders):
+    """ power tables X[i] = x**i & Y[j] = y**j used by polyval2d """
+    orderx, ordery = orders
+    X = np.asarray(x, dtype=float).reshape(1, -1) ** \
+        np.arange(orderx + 1).reshape(-1, 1)
+    Y = np.asarray(y, dtype=float).reshape(1, -1) ** \
+        np.arange(ordery + 1).reshape(-1, 1)
+    return X, Y
+
+
+def polyval2d_coefs(coefs, orders):
+    """ coefs as a (orderx + 1, ordery + 1) matrix, masked terms are 0 """
+    orderx, ordery = orders
+    # coefs are assigned to (i, j) in the order of
+    # itertools.product(range(orderx + 1), range(ordery + 1))
+    coefs = np.asarray(coefs, dtype=float).flatten()
+    n_coefs = np.min((coefs.size, (orderx + 1) * (ordery + 1)))
+    coefs_ij = np.zeros((orderx + 1, ordery + 1))
+    coefs_ij.flat[:n_coefs] = coefs[:n_coefs]
+    i, j = np.ogrid[:orderx + 1, :ordery + 1]
+    coefs_ij *= (i + j) < np.max((orderx, ordery))
+    return coefs_ij
+
+
+def polyval2d(x, y, coefs, orders=None, powers=None):
+    """ 2D polynomial, only terms with i + j < max(orderx, ordery) are used
+
+    powers:
+        (X, Y) from polyval2d_powers(x, y, orders), to be reused when x & y
+        are fixed, e.g., in an optimization (not used for orders=(3, 5),
+        which has a specialized kernel)
+    """
     if orders is None:
         orderx, ordery = coefs.shape
     else:
         orderx, ordery = orders
+    coefs_ij = polyval2d_coefs(coefs, (orderx, ordery))
 
-    ij = itertools.product(range(orderx + 1), range(ordery + 1))
-    z = np.zeros_like(x)
-    for a, (i, j) in zip(coefs.flatten(), ij):
-        if i + j < np.max((orderx, ordery)):
-            #        print a,i,j
-            z += a * x ** i * y ** j
-    return z
+    if (orderx, ordery) == (3, 5):
+        # the default poly_order of fit_grating_equation
+        z = _polyval2d_3_5_nb(np.asarray(x, dtype=float).ravel(),
+                              np.asarray(y, dtype=float).ravel(), coefs_ij)
+        return z.reshape(np.shape(x))
+
+    if powers is None:
+        powers = polyval2d_powers(x, y, (orderx, ordery))
+    X, Y = powers
+    z = np.einsum("ij,in,jn->n", coefs_ij, X, Y, optimize=True)
+    return z.reshape(np.shape(x))
 
 
 def gauss_poly1(x, p0, p1, a, b, c):
@@ -299,24 +979,104 @@ def gauss_poly0(x, p0, a, b, c):
     return p0 + a/np.sqrt(2.*np.pi)/c * np.exp(-0.5 * ((x - b) / c) ** 2.)
 
 
+def gauss_poly0_jac(x, p0, a, b, c):
+    """ analytic Jacobian of gauss_poly0, shape x.shape + (4,) """
+    inv = 1. / (c * np.sqrt(2. * np.pi))
+    e = np.exp(-0.5 * ((x - b) / c) ** 2.)
+    col_p0 = np.ones_like(x)
+    col_a = e * inv
+    col_b = a * inv * e * (x - b) / (c * c)
+    col_c = a * inv * e * ((x - b) ** 2. / c ** 3. - 1. / c)
+    return np.stack([col_p0, col_a, col_b, col_c], axis=-1)
+
+
 def gauss(x, a, b, c):
     return a/np.sqrt(2.*np.pi)/c * np.exp(-0.5 * ((x - b) / c) ** 2.)
 
 
-def residual_chi2(coefs, x, y, z, w, poly_order):
-    return np.nansum(residual(coefs, x, y, z, w, poly_order) ** 2.)
+def polyval2d_design(x, y, orders, n_coefs=None, powers=None):
+    """ design matrix of polyval2d, i.e., polyval2d(x, y, coefs, orders)
+    equals polyval2d_design(x, y, orders, coefs.size) @ coefs.flatten() """
+    orderx, ordery = orders
+    if n_coefs is None:
+        n_coefs = (orderx + 1) * (ordery + 1)
+    if powers is None:
+        powers = polyval2d_powers(x, y, orders)
+    X, Y = powers
+
+    design = np.zeros((X.shape[1], n_coefs))
+    for k in range(np.min((n_coefs, (orderx + 1) * (ordery + 1)))):
+        i, j = divmod(k, ordery + 1)
+        if i + j < np.max((orderx, ordery)):
+            design[:, k] = X[i] * Y[j]
+    return design
+
+
+def polyfit2d_lstsq(design, z, w):
+    """ weighted linear least squares fit of polyval2d coefs
+
+    Points with zero weight or non-finite z are ignored.
+    """
+    w = np.asarray(w, dtype=float)
+    ind_use = (w > 0) & np.isfinite(z)
+    coefs, *_ = np.linalg.lstsq(design[ind_use] * w[ind_use, None],
+                                z[ind_use] * w[ind_use], rcond=None)
+    return coefs
+
+
+def residual_chi2(coefs, x, y, z, w, poly_order, powers=None):
+    return np.nansum(residual(coefs, x, y, z, w, poly_order, powers) ** 2.)
 
 
 def residual_lar(coefs, x, y, z, w, poly_order):
-    fitted = polyval2d(x, y, coefs, poly_order)
-    return np.sqrt(np.abs((fitted - z) * w))
+    return _residual_lar_nb(
+        polyval2d_coefs(coefs, poly_order), np.asarray(x, dtype=float),
+        np.asarray(y, dtype=float), np.asarray(z, dtype=float),
+        np.asarray(w, dtype=float))
 
 
-def residual(coefs, x, y, z, w, poly_order):
-    fitted = polyval2d(x, y, coefs, poly_order)
+def residual(coefs, x, y, z, w, poly_order, powers=None):
+    fitted = polyval2d(x, y, coefs, poly_order, powers)
     return (fitted - z) * w
 
 
+# NaNs have to propagate (rejected points), so "nnan" is not assumed
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit("f8[:](f8[:, :], f8[:], f8[:], f8[:], f8[:])", cache=True,
+      fastmath=_FASTMATH)
+def _residual_lar_nb(coefs_ij, x, y, z, w):
+    """ residual_lar with polyval2d evaluated by nested Horner schemes """
+    out = np.empty_like(x)
+    for k in range(x.shape[0]):
+        acc_x = 0.
+        for i in range(coefs_ij.shape[0] - 1, -1, -1):
+            acc_y = 0.
+            for j in range(coefs_ij.shape[1] - 1, -1, -1):
+                acc_y = acc_y * y[k] + coefs_ij[i, j]
+            acc_x = acc_x * x[k] + acc_y
+        out[k] = np.sqrt(abs((acc_x - z[k]) * w[k]))
+    return out
+
+
+@njit("f8[:](f8[:], f8[:], f8[:, :])", cache=True, fastmath=_FASTMATH)
+def _polyval2d_3_5_nb(x, y, c):
+    """ polyval2d for orders=(3, 5), i.e., the terms with i + j < 5,
+    unrolled as Horner schemes in y nested in a Horner scheme in x """
+    z = np.empty_like(x)
+    for k in range(x.shape[0]):
+        xk = x[k]
+        yk = y[k]
+        p0 = c[0, 0] + yk * (c[0, 1] + yk * (c[0, 2] + yk * (
+            c[0, 3] + yk * c[0, 4])))
+        p1 = c[1, 0] + yk * (c[1, 1] + yk * (c[1, 2] + yk * c[1, 3]))
+        p2 = c[2, 0] + yk * (c[2, 1] + yk * c[2, 2])
+        p3 = c[3, 0] + yk * c[3, 1]
+        z[k] = p0 + xk * (p1 + xk * (p2 + xk * p3))
+    return z
+
+
 # ############################## #
 #      standardization
 # ############################## #
@@ -363,14 +1123,26 @@ def fit_grating_equation(lc_coord, lc_order, lc_thar, popt, pcov, ind_good_thar0
     weight = weight > 0
 
     # fit surface
-    x0 = np.zeros(poly_order)
+    # power tables & design matrix are fixed during the iterations
+    powers = polyval2d_powers(lc_coord_s, lc_order_s, poly_order)
+    design = polyval2d_design(lc_coord_s, lc_order_s, poly_order,
+                              n_coefs=np.prod(poly_order), powers=powers)
     #print(lc_coord_s, lc_order_s, ml_s, weight, poly_order)
-    x0, ier = leastsq(residual, x0,
-                      args=(lc_coord_s, lc_order_s, ml_s, weight, poly_order))
-    #print(x0, ier)
+    x0 = polyfit2d_lstsq(design, ml_s, weight)
+    #print(x0)
 
     # iter
     if n_iter > 0:
+        # orders are fixed, count the lines left in each order incrementally
+        lc_order_s_unique, ind_inverse = np.unique(lc_order_s, return_inverse=True)
+        lc_order_s_unique_left = np.bincount(
+            ind_inverse, weights=weight > 0,
+            minlength=len(lc_order_s_unique)).astype(int)
+        # lines which can not be cut, i.e., cut already or in orders with
+        # no more than nl_eachorder lines left
+        ind_fixed = ~np.isfinite(lc_thar) | (
+            lc_order_s_unique_left[ind_inverse] <= nl_eachorder)
+        wave_dev = np.zeros_like(lc_thar)
         n_loop = 0
         while n_loop < n_iter:
             n_loop += 1
@@ -378,25 +1150,26 @@ def fit_grating_equation(lc_coord, lc_order, lc_thar, popt, pcov, ind_good_thar0
                 x_mini_lsq, ier = leastsq(residual_lar, x0, args=(
                     lc_coord_s, lc_order_s, ml_s, weight, poly_order))
             else:
-                x_mini_lsq, ier = leastsq(residual, x0, args=(
-                    lc_coord_s, lc_order_s, ml_s, weight, poly_order))
-            fitted = polyval2d(lc_coord_s, lc_order_s, x_mini_lsq, poly_order)
+                x_mini_lsq = polyfit2d_lstsq(design, ml_s, weight)
+            fitted = polyval2d(lc_coord_s, lc_order_s, x_mini_lsq, poly_order,
+                               powers)
             fitted_wave = standardize_inverse(fitted, ml_mean, ml_std) / lc_order
             fitted_wave_diff = fitted_wave - lc_thar
 
-            wave_dev = np.abs(fitted_wave_diff - np.nanmedian(fitted_wave_diff))
-            lc_order_s_unique, ind_inverse = np.unique(lc_order_s, return_inverse=True)
-            lc_order_s_unique_left = np.zeros_like(lc_order_s_unique, dtype=int)
-            for i, _ in enumerate(lc_order_s_unique):
-                lc_order_s_unique_left[i] = np.sum(weight[lc_order_s == _] > 0)
-            lc_order_s_left = lc_order_s_unique_left[ind_inverse]
-            # print(lc_order_s_left)
+            np.subtract(fitted_wave_diff, np.nanmedian(fitted_wave_diff),
+                        out=wave_dev)
+            np.abs(wave_dev, out=wave_dev)
+            wave_dev[ind_fixed] = -np.inf
             # print(wave_dev)
-            # print(lc_order_s_left)
 
-            possible_outlier = wave_dev * (wave_dev > max_dev_threshold) * (lc_order_s_left > nl_eachorder)
-            if np.any(possible_outlier > 0):
-                ind_max_dev = np.nanargmax(possible_outlier)
+            ind_max_dev = np.argmax(wave_dev)
+            if wave_dev[ind_max_dev] > max_dev_threshold:
+                ind_fixed[ind_max_dev] = True
+                if weight[ind_max_dev] > 0:
+                    i_order = ind_inverse[ind_max_dev]
+                    lc_order_s_unique_left[i_order] -= 1
+                    if lc_order_s_unique_left[i_order] <= nl_eachorder:
+                        ind_fixed[ind_inverse == i_order] = True
                 weight[ind_max_dev] = 0.
                 ml_s[ind_max_dev] = np.nan
                 lc_thar[ind_max_dev] = np.nan
@@ -411,9 +1184,9 @@ def fit_grating_equation(lc_coord, lc_order, lc_thar, popt, pcov, ind_good_thar0
             x_mini_lsq, ier = leastsq(residual_lar, x0, args=(
                 lc_coord_s, lc_order_s, ml_s, weight, poly_order))
         else:
-            x_mini_lsq, ier = leastsq(residual, x0, args=(
-                lc_coord_s, lc_order_s, ml_s, weight, poly_order))
-        fitted = polyval2d(lc_coord_s, lc_order_s, x_mini_lsq, poly_order)
+            x_mini_lsq = polyfit2d_lstsq(design, ml_s, weight)
+        fitted = polyval2d(lc_coord_s, lc_order_s, x_mini_lsq, poly_order,
+                           powers)
         fitted_wave = standardize_inverse(fitted, ml_mean, ml_std) / lc_order
         fitted_wave_diff = fitted_wave - lc_thar
 
@@ -463,12 +1236,19 @@ def polyfit_reject(x, y, deg=1, w=None, epsilon=0.002, n_reserve=-1):
         n_reserve = np.int(n_good * n_reserve)
 
     # set up the iteration
+    # the weighted normal equations (in scaled x) are downdated by one point
+    # for each rejection instead of re-fitting all points
+    x_std = np.std(x_) if np.std(x_) > 0 else 1.
+    vander = np.vander((x_ - np.mean(x_)) / x_std, deg + 1)
+    vander_w = vander * w_[:, None]
+    ata = vander_w.T @ vander_w
+    aty = vander_w.T @ (y_ * w_)
     ind_reserved = np.ones_like(x_, bool)
     while np.sum(ind_reserved) > n_reserve:
         # p0 = np.polyfit(x_[ind_reserved], y_[ind_reserved], deg, w=w_[ind_reserved])
-        p0, ier = leastsq(polyfit_costfun_lar, np.zeros((deg+1,), float), args=(x_[ind_reserved], y_[ind_reserved], w_[ind_reserved]))
+        p0 = np.linalg.lstsq(ata, aty, rcond=None)[0]
 
-        y_res = y_ - np.polyval(p0, x_)
+        y_res = y_ - vander @ p0
         y_res = np.where(w_ > 0, y_res, np.nan)
         # y_res_std = np.nanstd(y_res)
         # y_res_med = np.nanmedian(y_res)
@@ -480,6 +1260,8 @@ def polyfit_reject(x, y, deg=1, w=None, epsilon=0.002, n_reserve=-1):
             i_rejected = np.nanargmax(np.abs(y_res))
             # print(i_rejected, np.abs(y_res)[i_rejected])
             ind_reserved[i_rejected] = False
+            ata -= np.outer(vander_w[i_rejected], vander_w[i_rejected])
+            aty -= vander_w[i_rejected] * y_[i_rejected] * w_[i_rejected]
             w_[i_rejected] = 0
             # print("@SONG: {0} points left".format(np.sum(ind_reserved)))
         else:
@@ -522,4 +1304,58 @@ def clean_thar_polyfit1d_reject(lc_coord, lc_order, lc_thar, popt,
 
     ind_good = np.zeros_like(lc_coord, bool)
     ind_good[sub_good] = True
-    return ind_good
\ No newline at end of file
+    return ind_good
+
+
+def test_fit_gauss_poly0(method="numba", centroid_method="fit", n_lines=60,
+                         seed=0):
+    """ compare the fits of ThAr lines by *method* & *centroid_method* with
+    curve_fit on a synthetic order, in blended (fit_width=5) & isolated
+    (fit_width=.3) windows """
+    rng = np.random.default_rng(seed)
+    wave = np.linspace(5000., 5060., 2048)
+    xcoord = np.arange(len(wave))
+    thar_list = np.sort(rng.uniform(5002., 5058., n_lines))
+    thar = 50. + np.sum(gauss(wave[:, None], 10 ** rng.uniform(2.5, 4.5, n_lines),
+                              thar_list, rng.uniform(.04, .08, n_lines)), axis=1)
+    thar = rng.poisson(thar).astype(float)
+    thar_list = thar_list + rng.normal(0., .01, n_lines)
+
+    for fit_width, lc_tol in ((5., 5.), (.3, .1)):
+        popt0, pcov0 = refine_thar_positions_order(
+            wave, xcoord, thar, thar_list, 0, fit_width=fit_width,
+            lc_tol=lc_tol, method="curve_fit")[3:]
+        popt1, pcov1 = refine_thar_positions_order(
+            wave, xcoord, thar, thar_list, 0, fit_width=fit_width,
+            lc_tol=lc_tol, method=method, centroid_method=centroid_method)[3:]
+        # only the variance of the center is estimated on the fast path
+        ind_fast = np.isfinite(pcov1[:, 2]) & np.isnan(pcov1[:, 0])
+        cost0 = np.zeros((n_lines,))
+        cost1 = np.zeros((n_lines,))
+        for i_thar_line, each_thar_line in enumerate(thar_list):
+            ind_local = (wave > each_thar_line - fit_width) * (
+                wave < each_thar_line + fit_width)
+            cost0[i_thar_line] = np.sum((gauss_poly0(
+                wave[ind_local], *popt0[i_thar_line]) - thar[ind_local]) ** 2.)
+            cost1[i_thar_line] = np.sum((gauss_poly0(
+                wave[ind_local], *popt1[i_thar_line]) - thar[ind_local]) ** 2.)
+        ind_same = (np.abs(cost1 - cost0) <= 1e-6 * cost0) & ~ind_fast
+        print("@TWODSPEC: [{}/{}] fit_width = {}, {}/{} lines in the same "
+              "minimum as curve_fit, {} in a worse one, {} on the fast "
+              "path".format(method, centroid_method, fit_width,
+                            np.sum(ind_same), n_lines,
+                            np.sum((cost1 > (1 + 1e-3) * cost0) & ~ind_fast),
+                            np.sum(ind_fast)))
+        # the amplitude must not collapse onto its lower bound
+        assert np.all(popt1[:, 1] > 1e-6 * popt0[:, 1])
+        # the center must be constrained if the fit is accepted
+        assert not np.any(pcov1[:, 2] == 0.)
+        if fit_width < 1.:
+            assert np.all(np.abs(popt1[ind_same, 2] - popt0[ind_same, 2]) < 1e-4)
+            # fast centers agree with curve_fit within their errors
+            assert np.all(np.abs(popt1[ind_fast, 2] - popt0[ind_fast, 2]) <
+                          3. * np.sqrt(pcov1[ind_fast, 2] + pcov0[ind_fast, 2]))
+        else:
+            # blended windows are never on the fast path
+            assert not np.any(ind_fast)
+    return
@@ -95,13 +95,15 @@ class CCD(np.ndarray):
         # ndarray constructor, but return an object of our type.
         # It also triggers a call to InfoArray.__array_finalize__
 
-        data = np.array(data, dtype=np.float, order=order)
+        # no copy if data is already a float64 array in the required order,
+        # i.e., the CCD instance shares memory with data
+        data = np.asarray(data, dtype=np.float64, order=order)
+        if offset != 0 or strides is not None:
+            data = np.ndarray(shape=data.shape, dtype=data.dtype, buffer=data,
+                              offset=offset, strides=strides, order=order)
 
         # substantiate
-        ccd = super(CCD, cls).__new__(cls, shape=data.shape,
-                                      dtype=data.dtype, buffer=data,
-                                      offset=offset, strides=strides,
-                                      order=order)
+        ccd = data.view(cls)
         # set info
         ccd.gain = gain
         ccd.ron = ron
@@ -134,13 +136,14 @@ class CCD(np.ndarray):
     def reads(fps=["",], method="median", std=False, hdu=0, gain=1., ron=0., unit="adu", trim=None, rot90=0):
         """ read and combine multiple ccd frames """
         # read
-        ccds = CCD([CCD.read(fp, hdu=hdu, gain=gain, ron=ron, unit=unit, trim=trim, rot90=rot90) for fp in fps])
+        ccds = np.stack([CCD.read(fp, hdu=hdu, gain=gain, ron=ron, unit=unit, trim=trim, rot90=rot90) for fp in fps], axis=0)
 
         # combine
+        # median may reorder ccds along axis 0, which does not change std
         if method == "median":
-            ccd_comb = np.median(ccds, axis=0)
+            ccd_comb = np.median(ccds, axis=0, overwrite_input=True).view(CCD)
         elif method == "mean":
-            ccd_comb = np.mean(ccds, axis=0)
+            ccd_comb = np.mean(ccds, axis=0).view(CCD)
         else:
             raise ValueError("@CCD.combine: bad method [{}]".format(method))
         # set info
@@ -154,7 +157,7 @@ class CCD(np.ndarray):
             return ccd_comb
         else:
             # evaluate std
-            ccd_std = np.std(ccds, axis=0)
+            ccd_std = np.std(ccds, axis=0).view(CCD)
             # set info
             ccd_std.gain = gain
             ccd_std.ron = ron
@@ -225,8 +228,11 @@ class CCD(np.ndarray):
         for k in self.extr_attr_list:
             self.__setattr__(k, ccd1.__getattribute__(k))
 
-    # def copy(self):
-    #     return np.copy(self)
+    def copy(self, order="C"):
+        """ copy data & info """
+        ccd = super(CCD, self).copy(order=order)
+        ccd.copy_info(self)
+        return ccd
 
     ###########################
     # get config
@@ -248,28 +254,32 @@ class CCD(np.ndarray):
     ###########################
     # arithmetic options
     ###########################
-    # def subtract(self, ccd1):
-    #     """ ccd2 = self - ccd1 """
-    #     ccd2 = self/ccd1
-    #     ccd2.copy_info(self)
-    #     return ccd2
-    #
+    def subtract(self, ccd1, out=None):
+        """ ccd2 = self - ccd1, in place if out is self """
+        ccd2 = np.subtract(self, ccd1, out=out)
+        if not isinstance(ccd2, CCD):
+            # e.g., out is a plain ndarray
+            ccd2 = ccd2.view(type(self))
+        ccd2.copy_info(self)
+        return ccd2
+
     # def devide(self, ccd1):
     #     """ ccd2 = self / ccd1 """
     #     ccd2 = self / ccd1
     #     ccd2.copy_info(self)
     #     return ccd2
 
-    # @staticmethod
-    # def combine(ccds, method="median"):
-    #     """ combine ccd frames """
-    #     ccds = CCD(ccds)
-    #     if method == "median":
-    #         return np.median(ccds, axis=0)
-    #     elif method == "mean":
-    #         return np.mean(ccds, axis=0)
-    #     else:
-    #         raise ValueError("@CCD.combine: bad method [{}]".format(method))
+    @staticmethod
+    def combine(ccds, method="median"):
+        """ combine ccd frames """
+        # the stacked array is a new one, so median can overwrite it
+        ccds = np.stack(ccds, axis=0)
+        if method == "median":
+            return np.median(ccds, axis=0, overwrite_input=True).view(CCD)
+        elif method == "mean":
+            return np.mean(ccds, axis=0).view(CCD)
+        else:
+            raise ValueError("@CCD.combine: bad method [{}]".format(method))
 
     # def mean(self, axis=None):
     #     return CCD(np.mean(self, axis=axis))